@@ -1,12 +1,27 @@
 import os
+import gc
 import cv2
 import streamlit as st
 from datetime import datetime
 from tempfile import NamedTemporaryFile
 from ultralytics import YOLO
+try:
+    from ultralytics.utils.nms import non_max_suppression # Ultralytics >= 8.3.200
+except ImportError: # Older releases keep it in ops
+    from ultralytics.utils.ops import non_max_suppression
+import torch
+import numpy as np
+try:
+    from numba import njit
+except ImportError: # Numba is optional; should_record() then runs as plain Python
+    def njit(*args, **kwargs):
+        return args[0] if args and callable(args[0]) else (lambda fn: fn)
 import time
-import mysql.connector # For MySQL
-from mysql.connector import Error # For MySQL error handling
+import math
+import queue
+import threading
+from collections import deque
+from db_logging import start_db_logging, db_connecting, db_connection_error, write_log_to_db, wait_for_db_logs # MySQL logging, off the script thread
 
 # --- Streamlit Page Configuration (MUST BE FIRST STREAMLIT COMMAND) ---
 st.set_page_config(layout="wide", page_title="Weapon Detection System")
@@ -28,59 +43,86 @@ DB_CONFIG = {
     'database': st.secrets.get("mysql.database", "") # e.g., "weapon_detection_db"
 }
 
-# --- Database Connection Function & Table Creation ---
-@st.cache_resource # Cache the connection across reruns
-def get_db_connection():
-    try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        if conn.is_connected():
-            print("Successfully connected to MySQL database")
-            return conn
-    except Error as e:
-        st.error(f"DB Connection Error: {e}")
-        print(f"DB Connection Error: {e}")
-        return None
-    return None
-
-def create_logs_table_if_not_exists(_conn):
-    if _conn is None or not _conn.is_connected():
-        st.warning("DB not connected, cannot create/check logs table.")
-        return
-    cursor = None
-    try:
-        cursor = _conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS detection_logs (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                timestamp DATETIME NOT NULL,
-                log_level VARCHAR(20) NOT NULL,
-                message TEXT NOT NULL,
-                video_source VARCHAR(255) NULL,
-                clip_path VARCHAR(255) NULL
-            );
-        """)
-        _conn.commit()
-        print("detection_logs table checked/created successfully.")
-    except Error as e:
-        st.error(f"DB Table Creation Error: {e}")
-        print(f"DB Table Creation Error: {e}")
-    finally:
-        if cursor:
-            cursor.close()
+# --- Database Logging ---
+# Starts the log worker, which connects and creates the table; the script thread only reads the outcome
+start_db_logging(DB_CONFIG)
+db_status_placeholder = st.empty()
+
+def show_db_status():
+    # The worker's first dial may still be running on the first page load, so this is refreshed when processing starts
+    if db_connection_error():
+        db_status_placeholder.warning("DATABASE ALERT: Could not connect to MySQL. Logs will NOT be saved to the database for this session.")
+    elif db_connecting():
+        db_status_placeholder.info("DATABASE: Connecting to MySQL...")
+    else:
+        db_status_placeholder.empty()
 
-# Attempt to connect and create table on app startup
-db_connection_global = get_db_connection() # Store the initial connection attempt
-if db_connection_global:
-    create_logs_table_if_not_exists(db_connection_global)
-else:
-    st.warning("DATABASE ALERT: Could not connect to MySQL. Logs will NOT be saved to the database for this session.")
+show_db_status()
 
 # --- Initialize YOLO models ---
+BATCH = 8 # Frames per batched forward pass (file inputs) when the GPU benchmark does not run
+BATCH_CANDIDATES = (1, 2, 4, 8, 16, 32) # Batch sizes tried by select_batch_size()
+BENCH_ITERS = 2 # Timed passes per candidate, each over one full keyframe/preview cycle of batches
+IMGSZ = 640 # Inference size for both models; frames are letterboxed to IMGSZ x IMGSZ once per batch
+EXPORT_INT8 = False # INT8 TensorRT engines need a calibration dataset, see INT8_CALIB_DATA
+INT8_CALIB_DATA = "calib.yaml"
+WARMUP_ITERS = 3 # Dummy inferences after load so the first real frame skips CUDA/cuDNN init
+DETECT_EVERY_N = 3 # Weapon model runs on every Nth frame; its boxes are reused in between
+REC_WINDOW = 8 # Recent keyframe weapon results the recording hysteresis looks at
+REC_START_MIN = 3 # A clip starts once this many of the last REC_WINDOW keyframes saw a weapon, and stops when none did
+DETECT_CONF = 0.5 # Minimum confidence for a box to count / be drawn
+DISPLAY_EVERY_N = 2 # Only every Nth frame is annotated and sent to the browser
+PREVIEW_WIDTH = 960 # Wider preview frames are downscaled before display
+COMBINED_MODEL_PATH = "combined.pt" # Optional single model trained on the 80 COCO classes followed by the weapon classes
+COCO_CLASS_COUNT = 80 # In the combined model, class ids >= this are weapons (first weapon class -> 0)
+
+def warm_up(model):
+    dummy = np.zeros((IMGSZ, IMGSZ, 3), dtype=np.uint8) # Also sets up model.predictor, used directly per batch
+    for _ in range(WARMUP_ITERS):
+        model(dummy, verbose=False, half=True, imgsz=IMGSZ)
+    return model
+
+def check_batch_capacity(model):
+    # detect_subset() calls the backend directly with up to max(BATCH_CANDIDATES) rows. A fixed-batch export (e.g. a
+    # plain `yolo export`) passes the single-frame warm-up but fails here instead of inside the frame loop.
+    backend = model.predictor.model
+    x = torch.zeros((max(BATCH_CANDIDATES), 3, IMGSZ, IMGSZ), device=backend.device)
+    with torch.inference_mode():
+        backend(x.half() if backend.fp16 else x)
+    return model
+
+def load_optimized_model(pt_path):
+    # TensorRT engine on GPU hosts, OpenVINO on CPU-only hosts. Exported once next to the .pt file and reused.
+    base_path = os.path.splitext(pt_path)[0]
+    if torch.cuda.is_available():
+        export_path = f"{base_path}.engine"
+        export_args = dict(format="engine", half=True, int8=EXPORT_INT8, dynamic=True, batch=max(BATCH_CANDIDATES), imgsz=IMGSZ)
+        if EXPORT_INT8: export_args["data"] = INT8_CALIB_DATA
+    else:
+        export_path = f"{base_path}_openvino_model"
+        export_args = dict(format="openvino", dynamic=True, batch=max(BATCH_CANDIDATES), imgsz=IMGSZ) # Dynamic so batched file input works
+    try:
+        if os.path.exists(export_path):
+            try: # Loading is lazy; a stale, half-written or fixed-batch artifact fails here
+                return check_batch_capacity(warm_up(YOLO(export_path, task="detect")))
+            except Exception as e:
+                print(f"Existing {export_path} unusable, re-exporting: {e}")
+        else:
+            print(f"Exporting {pt_path} to {export_args['format']} (one-time)...")
+        export_path = YOLO(pt_path).export(**export_args)
+        return check_batch_capacity(warm_up(YOLO(export_path, task="detect")))
+    except Exception as e:
+        print(f"Exported model unusable for {pt_path}, falling back to PyTorch weights: {e}")
+        return warm_up(YOLO(pt_path))
+
 @st.cache_resource
 def load_models():
     try:
-        weapon_model = YOLO("best.pt")
-        effect_model = YOLO("yolov8n.pt")
+        if os.path.exists(COMBINED_MODEL_PATH): # One backbone pass serves both weapon and object detection
+            weapon_model = effect_model = load_optimized_model(COMBINED_MODEL_PATH)
+        else:
+            weapon_model = load_optimized_model("best.pt")
+            effect_model = load_optimized_model("yolov8n.pt")
         print("YOLO Models loaded successfully.")
         return weapon_model, effect_model
     except Exception as e:
@@ -93,8 +135,44 @@ if weapon_model is None or effect_model is None:
     st.error("CRITICAL ERROR: YOLO models could not be loaded. The application cannot continue. Check model paths.")
     st.stop()
 
-# --- COCO Labels, Output Folder, Sample Videos ---
-coco_labels = [
+@st.cache_resource # Benchmarked once per source resolution
+def select_batch_size(_weapon_model, _effect_model, fw, fh):
+    # Times the production per-batch path (letterbox_needed + run_models over each batch's keyframe/preview frames) for every
+    # candidate, then picks the largest batch within 5% of the best ms/frame whose device memory use stays under 70%.
+    # Each pass covers the consecutive batches of one keyframe/preview cycle, so every candidate does its steady-state
+    # share of weapon/object rows and letterboxing per frame, on frames of the source's size
+    if not torch.cuda.is_available(): return BATCH
+    device = _weapon_model.predictor.model.device
+    cycle = math.lcm(DETECT_EVERY_N, DISPLAY_EVERY_N)
+    frame = np.zeros((fh if fh > 0 else IMGSZ, fw if fw > 0 else IMGSZ, 3), dtype=np.uint8)
+    timings = []
+    for b in BATCH_CANDIDATES:
+        frames = [frame] * b # Host frames, so letterboxing and upload are timed too
+        try:
+            free_before = torch.cuda.mem_get_info(device)[0]
+            for it in range(BENCH_ITERS + 1): # First pass is untimed and absorbs per-shape setup
+                if it == 1: torch.cuda.synchronize(device); t0 = time.perf_counter()
+                for k in range(cycle):
+                    key_idx, disp_idx = batch_indices(k * b, b)
+                    tensor, geometry, used = letterbox_needed(frames, key_idx, disp_idx, device)
+                    run_models(_weapon_model, _effect_model, tensor, used, key_idx, disp_idx, geometry)
+            torch.cuda.synchronize(device)
+        except (RuntimeError, AssertionError) as e: # CUDA OOM, or Ultralytics' TensorRT shape assert beyond the exported max batch
+            print(f"Batch benchmark stopped at batch={b}: {e}")
+            torch.cuda.empty_cache(); break
+        ms_per_frame = (time.perf_counter() - t0) * 1000 / (BENCH_ITERS * cycle * b)
+        free_after, total_mem = torch.cuda.mem_get_info(device) # Device-wide, so TensorRT/cuDNN workspaces count too
+        timings.append((b, ms_per_frame, total_mem - free_after, total_mem, free_before - free_after))
+    if not timings: return BATCH
+    best_ms = min(t[1] for t in timings)
+    usable = [b for b, ms, used, total_mem, _ in timings if ms <= 1.05 * best_ms and used < 0.7 * total_mem]
+    chosen = max(usable) if usable else timings[0][0]
+    print("Batch benchmark (batch, ms/frame, MiB grown): "
+          + ", ".join(f"({b}, {ms:.2f}, {grown / 2**20:.0f})" for b, ms, _, _, grown in timings) + f" -> using {chosen}")
+    return chosen
+
+# --- COCO Labels, Annotation Constants, Output Folder, Sample Videos ---
+COCO_LABELS = (
     "person", "bicycle", "car", "motorcycle", "airplane", "bus", "train", "truck", "boat", "traffic light",
     "fire hydrant", "stop sign", "parking meter", "bench", "bird", "cat", "dog", "horse", "sheep", "cow",
     "elephant", "bear", "zebra", "giraffe", "backpack", "umbrella", "handbag", "tie", "suitcase", "frisbee",
@@ -104,7 +182,10 @@ coco_labels = [
     "potted plant", "bed", "dining table", "toilet", "TV", "laptop", "mouse", "remote", "keyboard",
     "cell phone", "microwave", "oven", "toaster", "sink", "refrigerator", "book", "clock", "vase",
     "scissors", "teddy bear", "hair drier", "toothbrush"
-]
+)
+WEAPON_LABEL = "Weapon" # Default, can be model.names[cls]
+WEAPON_COLOR = (0, 0, 255); OBJ_COLOR = (255, 0, 0) # BGR
+FONT = cv2.FONT_HERSHEY_SIMPLEX; FONT_SCALE = 0.5; LINE_THICKNESS = 2
 output_folder = "detected_clips"
 os.makedirs(output_folder, exist_ok=True)
 SAMPLE_VIDEOS = {
@@ -123,47 +204,13 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- Session State Variables ---
-if "log" not in st.session_state: st.session_state.log = ""
+MAX_LOG_LINES = 100
+if "log" not in st.session_state: st.session_state.log = deque(maxlen=MAX_LOG_LINES) # Newest entry first
 if "stop_camera" not in st.session_state: st.session_state.stop_camera = False
 if "is_processing" not in st.session_state: st.session_state.is_processing = False
 if "current_video_source" not in st.session_state: st.session_state.current_video_source = None
 if "current_video_path" not in st.session_state: st.session_state.current_video_path = None
 
-# --- Helper Function: write_log_to_db ---
-def write_log_to_db(level, message, video_source=None, clip_path=None):
-    conn = get_db_connection() # Use the cached connection
-    if conn is None or not conn.is_connected():
-        # Try to re-establish if initial connection failed or was lost
-        global db_connection_global
-        if not db_connection_global or not db_connection_global.is_connected():
-            print("Attempting to reconnect to DB for logging...")
-            db_connection_global = get_db_connection()
-            if db_connection_global: create_logs_table_if_not_exists(db_connection_global)
-        
-        conn = db_connection_global # Use the (potentially) re-established global connection
-
-        if conn is None or not conn.is_connected():
-            print(f"DB LOG SKIP (No Connection): {level} - {message}")
-            return
-
-    cursor = None
-    try:
-        cursor = conn.cursor()
-        sql = """
-            INSERT INTO detection_logs (timestamp, log_level, message, video_source, clip_path)
-            VALUES (%s, %s, %s, %s, %s)
-        """
-        val = (datetime.now(), str(level).upper(), str(message),
-               str(video_source) if video_source else None,
-               str(clip_path) if clip_path else None)
-        cursor.execute(sql, val)
-        conn.commit()
-    except Error as e:
-        print(f"DB LOG WRITE ERROR: {e} for message: '{message}'") # Log to console, not st.error
-        if conn: conn.rollback()
-    finally:
-        if cursor: cursor.close()
-
 # --- MODIFIED Helper Function: write_log ---
 def write_log(message, placeholder_to_update=None, is_error=False,
               log_level_for_db="INFO", db_video_source=None, db_clip_path=None):
@@ -186,10 +233,7 @@ def write_log(message, placeholder_to_update=None, is_error=False,
 
 
     new_session_log_entry = f"[{timestamp}] {ui_prefix} {message}"
-    st.session_state.log = new_session_log_entry + "\n" + st.session_state.log
-    max_log_lines = 100
-    log_lines = st.session_state.log.splitlines()
-    if len(log_lines) > max_log_lines: st.session_state.log = "\n".join(log_lines[:max_log_lines])
+    st.session_state.log.appendleft(new_session_log_entry) # deque maxlen drops the oldest entry
 
     if placeholder_to_update:
         if actual_db_log_level == "ERROR": placeholder_to_update.error(f"🔴 Latest: {message}")
@@ -235,9 +279,17 @@ with st.sidebar:
                 write_log(f"Sample '{selected_sample}' selected.", log_level_for_db="SYSTEM_EVENT")
                 st.rerun()
     st.markdown("---")
+    if st.button("♻️ Reload Models", key="reload_models", disabled=st.session_state.is_processing, use_container_width=True):
+        load_models.clear(); select_batch_size.clear() # Drop cached entries so the next run loads fresh ones
+        weapon_model = effect_model = None # Last references to the old models; without this nothing is freed below
+        gc.collect()
+        if torch.cuda.is_available(): torch.cuda.empty_cache()
+        write_log("Model reload requested.", log_level_for_db="SYSTEM_EVENT")
+        st.rerun()
+    st.markdown("---")
     st.subheader("📝 Session Log")
     st.markdown('<div class="log-container">', unsafe_allow_html=True)
-    st.text_area("LogView", value=st.session_state.log, height=250, disabled=True, key="session_log_area", label_visibility="collapsed")
+    st.text_area("LogView", value="\n".join(st.session_state.log), height=250, disabled=True, key="session_log_area", label_visibility="collapsed")
     st.markdown('</div>', unsafe_allow_html=True)
 
 # Main Area
@@ -249,6 +301,159 @@ st.markdown('<div class="latest-log-info">', unsafe_allow_html=True)
 status_placeholder = st.empty()
 st.markdown('</div>', unsafe_allow_html=True)
 
+# --- Detection Helpers ---
+@njit(cache=True)
+def should_record(ring, recording, start_min):
+    # Hysteresis: start on start_min positives in the window, keep the clip open until the window is all negative
+    positives = 0
+    for k in range(ring.shape[0]):
+        if ring[k]: positives += 1
+    return positives > 0 if recording else positives >= start_min
+
+NMS_CONF = 0.25 # Same defaults Ultralytics' predict() applies
+NMS_IOU = 0.7
+
+def letterbox_batch(frames, device):
+    # Letterbox once per batch and upload as one uint8 NCHW RGB tensor that both models share
+    h, w = frames[0].shape[:2]
+    scale = min(IMGSZ / h, IMGSZ / w)
+    nh, nw = round(h * scale), round(w * scale)
+    pad_y, pad_x = (IMGSZ - nh) // 2, (IMGSZ - nw) // 2
+    canvas = np.full((len(frames), IMGSZ, IMGSZ, 3), 114, dtype=np.uint8) # Ultralytics' letterbox fill value
+    for j, f in enumerate(frames):
+        canvas[j, pad_y:pad_y + nh, pad_x:pad_x + nw] = f if (nh, nw) == (h, w) else cv2.resize(f, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    # BGR -> RGB on device. Indexing keeps the channels-last strides, and TensorRT reads data_ptr() as dense NCHW
+    tensor = torch.from_numpy(canvas).to(device, non_blocking=True).permute(0, 3, 1, 2)[:, [2, 1, 0]].contiguous()
+    return tensor, (scale, pad_x, pad_y, w, h)
+
+def detect_subset(model, tensor, idx, geometry):
+    # Forward pass + NMS over tensor[idx]; returns {index: (cls, conf, xyxy)} in original frame pixels
+    if not idx: return {}
+    backend = model.predictor.model # AutoBackend, set up by the warm-up calls in load_models()
+    x = (tensor if len(idx) == len(tensor) else tensor[idx]).to(backend.device).contiguous() # idx is sorted and unique, so equal length = every row
+    x = (x.half() if backend.fp16 else x.float()) / 255.0
+    with torch.inference_mode():
+        preds = non_max_suppression(backend(x), conf_thres=NMS_CONF, iou_thres=NMS_IOU)
+    scale, pad_x, pad_y, w, h = geometry
+    dets = {}
+    for i, det in zip(idx, preds):
+        det = det.cpu().numpy() # One device->host copy per image: rows of x1, y1, x2, y2, conf, cls
+        xyxy = np.clip((det[:, :4] - (pad_x, pad_y, pad_x, pad_y)) / scale, 0, (w, h, w, h)) # Clipped like Ultralytics' scale_boxes
+        dets[i] = (det[:, 5].astype(np.int32), det[:, 4], xyxy.astype(np.int32))
+    return dets
+
+def split_combined(dets, idx, weapon):
+    # Picks weapon (cls >= COCO_CLASS_COUNT, re-based to 0) or COCO rows out of combined-model detections
+    split = {}
+    for i in idx:
+        cls, conf, xyxy = dets[i]
+        mask = cls >= COCO_CLASS_COUNT if weapon else cls < COCO_CLASS_COUNT
+        split[i] = (cls[mask] - COCO_CLASS_COUNT if weapon else cls[mask], conf[mask], xyxy[mask])
+    return split
+
+def draw_detections(img, xyxy, colors, labels):
+    # One pass over both models' boxes; label anchors are computed for all rows at once
+    anchors = xyxy[:, :2] - (0, 10)
+    for (x1,y1,x2,y2), anchor, color, label in zip(xyxy.tolist(), anchors.tolist(), colors, labels):
+        cv2.rectangle(img, (x1,y1),(x2,y2), color, LINE_THICKNESS)
+        cv2.putText(img, label, tuple(anchor), FONT, FONT_SCALE, color, LINE_THICKNESS)
+
+def batch_indices(batch_start, n):
+    # Frames of a batch that get the weapon model (keyframes) and the object model (preview frames)
+    key_idx = [i for i in range(n) if (batch_start + i) % DETECT_EVERY_N == 0]
+    disp_idx = [i for i in range(n) if (batch_start + i) % DISPLAY_EVERY_N == 0]
+    return key_idx, disp_idx
+
+def letterbox_needed(frames, key_idx, disp_idx, device):
+    # Letterboxes only the frames some model will see; tensor row j holds frames[used[j]]
+    used = sorted(set(key_idx) | set(disp_idx))
+    if not used: return None, None, used # e.g. webcam frames that are neither keyframes nor preview frames
+    tensor, geometry = letterbox_batch([frames[i] for i in used], device)
+    return tensor, geometry, used
+
+def run_models(weapon_model, effect_model, tensor, used, key_idx, disp_idx, geometry):
+    # key_idx/disp_idx are frame indices into the batch; results come back keyed the same way
+    if not used: return {}, {}
+    row = {i: j for j, i in enumerate(used)} # Frame index -> tensor row
+    key_rows = [row[i] for i in key_idx]; disp_rows = [row[i] for i in disp_idx]
+    if weapon_model is effect_model: # Combined model: one forward pass over every row, split by class range
+        dets = detect_subset(weapon_model, tensor, list(range(len(used))), geometry)
+        weapon_res, effect_res = split_combined(dets, key_rows, weapon=True), split_combined(dets, disp_rows, weapon=False)
+    else:
+        weapon_res = detect_subset(weapon_model, tensor, key_rows, geometry)
+        effect_res = detect_subset(effect_model, tensor, disp_rows, geometry) # Object boxes are only drawn, never recorded
+    return {used[j]: d for j, d in weapon_res.items()}, {used[j]: d for j, d in effect_res.items()}
+
+# --- Pipeline Stages (decode and clip writing run off the script thread) ---
+PIPELINE_QUEUE_SIZE = 4 # Max frames buffered between stages
+PIPELINE_GET_TIMEOUT = 1.0 # Seconds between reader liveness checks while waiting for a frame
+
+def put_until_stopped(q, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1); return True
+        except queue.Full: continue
+    return False
+
+def read_frames(cap, q_in, stop_event, realtime):
+    # Decode stage: pushes BGR frames into q_in, then None once the source is exhausted or reading fails
+    try:
+        while not stop_event.is_set():
+            ret, frame = cap.read()
+            if not ret: break
+            if realtime: # Drop the oldest queued frame instead of letting latency build up
+                try: q_in.put_nowait(frame)
+                except queue.Full:
+                    try: q_in.get_nowait()
+                    except queue.Empty: pass
+                    q_in.put_nowait(frame)
+            elif not put_until_stopped(q_in, frame, stop_event): break
+    except Exception as e:
+        print(f"Frame reader error: {e}")
+    finally:
+        put_until_stopped(q_in, None, stop_event) # Always posted so the main loop never waits on a dead reader
+
+def write_clip_frames(q_out):
+    # Write stage: (writer, frame) appends a frame, (writer, None) closes the clip, None ends the thread
+    while True:
+        item = q_out.get()
+        if item is None: break
+        writer, frame = item
+        try:
+            if frame is None: writer.release()
+            else: writer.write(frame)
+        except Exception as e: # Keep draining, otherwise q_out fills up and the main loop blocks on put()
+            print(f"Clip writer error: {e}")
+
+# --- Video I/O ---
+CLIP_FOURCCS = ("avc1", "mp4v") # H.264 first, MPEG-4 Part 2 as the always-available fallback
+
+def open_capture(video_input):
+    if isinstance(video_input, str):
+        # FFmpeg backend with hardware decoding (CUDA/VAAPI/D3D11) when the OpenCV build supports it
+        if hasattr(cv2, "CAP_PROP_HW_ACCELERATION"):
+            cap = cv2.VideoCapture(video_input, cv2.CAP_FFMPEG, [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY])
+            if cap.isOpened(): return cap
+        return cv2.VideoCapture(video_input, cv2.CAP_FFMPEG)
+    cap = cv2.VideoCapture(video_input)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1) # Live source: read() should return the newest frame, not a stale one
+    return cap
+
+def open_clip_writer(path, fps, size):
+    # Hardware H.264 encoding (NVENC/QSV/VAAPI) where the OpenCV build supports it, software otherwise
+    hw_params = None
+    if hasattr(cv2, "VIDEOWRITER_PROP_HW_ACCELERATION"):
+        hw_params = [cv2.VIDEOWRITER_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+    writer = None
+    for codec in CLIP_FOURCCS:
+        fourcc = cv2.VideoWriter_fourcc(*codec)
+        if hw_params:
+            writer = cv2.VideoWriter(path, cv2.CAP_FFMPEG, fourcc, fps, size, hw_params)
+            if writer.isOpened(): return writer
+        writer = cv2.VideoWriter(path, fourcc, fps, size)
+        if writer.isOpened(): return writer
+    return writer # Not opened; caller reports the error
+
 # --- Core Processing Function ---
 def process_video_feed(video_input, status_ph): # video_input is path or 0 for webcam
     cap = None
@@ -259,11 +464,11 @@ def process_video_feed(video_input, status_ph): # video_input is path or 0 for w
             msg = f"Video file not found: {video_input}"
             st.error(msg); write_log(msg, status_ph, is_error=True, db_video_source=video_input)
             st.session_state.is_processing = False; st.session_state.stop_camera = True; return
-        cap = cv2.VideoCapture(video_input)
+        cap = open_capture(video_input)
         ui_source_name = os.path.basename(video_input); db_source_name = ui_source_name
         write_log(f"Processing video: {ui_source_name}...", status_ph, db_video_source=db_source_name)
     else:
-        cap = cv2.VideoCapture(video_input) # 0 for webcam
+        cap = open_capture(video_input) # 0 for webcam
         write_log("Attempting to start webcam...", status_ph, db_video_source=db_source_name)
 
     if not cap or not cap.isOpened():
@@ -273,6 +478,7 @@ def process_video_feed(video_input, status_ph): # video_input is path or 0 for w
         if cap: cap.release(); return
 
     status_ph.info(f"⏳ Processing {ui_source_name}...")
+    show_db_status() # Startup may have rendered before the first connection attempt finished
     write_log("Video source opened.", None, db_video_source=db_source_name) # Log to sidebar, not overwriting status_ph
 
     recording = False; out = None; current_clip_path = ""
@@ -280,70 +486,113 @@ def process_video_feed(video_input, status_ph): # video_input is path or 0 for w
     fw = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)); fh = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
     if fps <= 0 or fps > 120: fps = 20.0 # Default FPS
 
+    device = weapon_model.predictor.model.device # Preprocessed batches are uploaded here once
+    frame_idx = 0
+    gate_ring = np.zeros(REC_WINDOW, dtype=np.bool_); gate_head = 0 # Ring of recent keyframe weapon results
+    w_conf = np.empty(0, np.float32); w_xyxy = np.empty((0, 4), np.int32) # Latest weapon detections
+    annot_frame = None # Preview buffer, allocated on the first preview frame and reused after that
+    tensor = weapon_res = effect_res = None # Bound up front so the cleanup below can always drop them
+
+    # Display stays on this thread: Streamlit elements can only be updated from the script thread
+    stop_event = threading.Event()
+    q_in = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE); q_out = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    reader = threading.Thread(target=read_frames, args=(cap, q_in, stop_event, not isinstance(video_input, str)), daemon=True)
+    clip_writer = threading.Thread(target=write_clip_frames, args=(q_out,), daemon=True)
+    reader.start(); clip_writer.start()
+
     try:
+        # Runs real inference, so it sits inside the try: a failure still releases the capture, resets the session and
+        # returns normally, so the temp-file cleanup at the end of the script runs on this same rerun
+        try: batch_size = select_batch_size(weapon_model, effect_model, fw, fh) if isinstance(video_input, str) else 1 # Webcam stays unbatched to keep latency low
+        except Exception as e:
+            msg = f"Error selecting batch size: {e}"
+            st.error(msg); write_log(msg, status_ph, is_error=True, db_video_source=db_source_name)
+            return
+        frame_batch = deque(maxlen=batch_size)
         while not st.session_state.stop_camera:
-            ret, frame = cap.read()
-            if not ret:
+            try: item = q_in.get(timeout=PIPELINE_GET_TIMEOUT) # None marks end of stream
+            except queue.Empty:
+                if reader.is_alive(): continue
+                item = None # Reader is gone without posting its sentinel: treat as end of stream
+            if item is not None: frame_batch.append(item)
+
+            if frame_batch and (item is None or len(frame_batch) == batch_size):
+                frames = list(frame_batch); frame_batch.clear()
+                batch_start = frame_idx; frame_idx += len(frames)
+                key_idx, disp_idx = batch_indices(batch_start, len(frames))
+                tensor, geometry, used = letterbox_needed(frames, key_idx, disp_idx, device) # Frames no model needs are never preprocessed
+                weapon_res, effect_res = run_models(weapon_model, effect_model, tensor, used, key_idx, disp_idx, geometry)
+
+                for i, frame in enumerate(frames):
+                    now_time = datetime.now()
+
+                    is_keyframe = i in weapon_res
+                    if is_keyframe:
+                        w_cls, w_conf, w_xyxy = weapon_res[i]
+                        w_mask = (w_cls == 0) & (w_conf > DETECT_CONF) # Assuming class 0 is weapon
+                        w_conf = w_conf[w_mask]; w_xyxy = w_xyxy[w_mask] # Kept for drawing until the next keyframe
+                        gate_head = (gate_head + 1) % REC_WINDOW
+                        gate_ring[gate_head] = w_mask.any()
+                    weapon_detected_this_frame = len(w_conf) > 0
+
+                    # The ring only moves on keyframes; short gaps keep the same VideoWriter and clip open
+                    want_recording = should_record(gate_ring, recording, REC_START_MIN)
+                    if not recording and want_recording:
+                        ts_date = now_time.strftime("%d-%m-%y"); ts_time = now_time.strftime("%H-%M-%S")
+                        vid_fname = f"{WEAPON_LABEL}_{ts_date}_{ts_time}.mp4"
+                        current_clip_path = os.path.join(output_folder, vid_fname)
+                        out = open_clip_writer(current_clip_path, fps, (fw,fh))
+                        if not out.isOpened():
+                            msg = f"Error opening VideoWriter: {current_clip_path}"
+                            st.error(msg); write_log(msg, status_ph, is_error=True, db_video_source=db_source_name)
+                            st.session_state.stop_camera=True; break
+                        recording = True
+                        write_log(f"REC Start: {vid_fname}", status_ph, log_level_for_db="RECORDING_EVENT", db_clip_path=current_clip_path)
+                    elif recording and not want_recording:
+                        recording=False
+                        if out: q_out.put((out, None)); out=None
+                        write_log(f"REC Stop: {os.path.basename(current_clip_path)}", status_ph, log_level_for_db="RECORDING_EVENT", db_clip_path=current_clip_path)
+                        current_clip_path = ""
+                    if recording and out: q_out.put((out, frame)) # Original frame
+                    if is_keyframe and weapon_detected_this_frame:
+                        log_ts = now_time.strftime("%I:%M:%S %p")
+                        write_log(f"{WEAPON_LABEL} detected @{log_ts}", status_ph, log_level_for_db="DETECTION", db_clip_path=current_clip_path if recording else None)
+
+                    if i not in effect_res: continue # Not a preview frame: skip annotation and display entirely
+                    if annot_frame is None or annot_frame.shape != frame.shape: annot_frame = np.empty_like(frame)
+                    np.copyto(annot_frame, frame) # In-place: no new full-resolution array per frame
+                    e_cls, e_conf, e_xyxy = effect_res[i]
+                    e_mask = e_conf > DETECT_CONF
+                    e_cls = np.minimum(e_cls[e_mask], len(COCO_LABELS) - 1) # Clamp once instead of a bounds check per box
+                    labels = [f"{WEAPON_LABEL} ({conf:.2f})" for conf in w_conf.tolist()]
+                    labels += [f"{COCO_LABELS[cls]} ({conf:.2f})" for cls, conf in zip(e_cls.tolist(), e_conf[e_mask].tolist())]
+                    colors = [WEAPON_COLOR] * len(w_conf) + [OBJ_COLOR] * len(e_cls)
+                    draw_detections(annot_frame, np.concatenate([w_xyxy, e_xyxy[e_mask]]), colors, labels)
+
+                    preview = annot_frame
+                    ah, aw = annot_frame.shape[:2]
+                    if aw > PREVIEW_WIDTH: # Smaller preview means fewer bytes over the Streamlit websocket
+                        preview = cv2.resize(annot_frame, (PREVIEW_WIDTH, ah * PREVIEW_WIDTH // aw), interpolation=cv2.INTER_AREA)
+                    frame_placeholder.image(preview, channels="BGR", use_container_width=True)
+
+            if item is None:
                 write_log("End of video or stream error.", status_ph, db_video_source=db_source_name)
                 break
-
-            weapon_res = weapon_model(frame, verbose=False, half=True)
-            effect_res = effect_model(frame, verbose=False, half=True)
-            annot_frame = frame.copy()
-            weapon_detected_this_frame = False
-            detected_weapon_name = "Weapon" # Default, can be model.names[cls]
-            now_time = datetime.now()
-
-            for r in weapon_res:
-                if r.boxes is not None:
-                    for box in r.boxes:
-                        cls = int(box.cls.item()); conf = float(box.conf.item())
-                        if cls == 0 and conf > 0.5: # Assuming class 0 is weapon
-                            weapon_detected_this_frame = True
-                            x1,y1,x2,y2 = map(int, box.xyxy[0].tolist())
-                            cv2.rectangle(annot_frame, (x1,y1),(x2,y2), (0,0,255),2)
-                            cv2.putText(annot_frame, f"{detected_weapon_name} ({conf:.2f})", (x1,y1-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5,(0,0,255),2)
-            for r in effect_res:
-                if r.boxes is not None:
-                    for box in r.boxes:
-                        cls = int(box.cls.item()); conf = float(box.conf.item())
-                        if conf > 0.5:
-                            obj_name = coco_labels[cls] if cls < len(coco_labels) else f"Obj-{cls}"
-                            x1,y1,x2,y2 = map(int, box.xyxy[0].tolist())
-                            cv2.rectangle(annot_frame, (x1,y1),(x2,y2), (255,0,0),2)
-                            cv2.putText(annot_frame, f"{obj_name} ({conf:.2f})", (x1,y1-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5,(255,0,0),2)
-
-            if weapon_detected_this_frame:
-                if not recording:
-                    ts_date = now_time.strftime("%d-%m-%y"); ts_time = now_time.strftime("%H-%M-%S")
-                    vid_fname = f"{detected_weapon_name}_{ts_date}_{ts_time}.mp4"
-                    current_clip_path = os.path.join(output_folder, vid_fname)
-                    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-                    out = cv2.VideoWriter(current_clip_path, fourcc, fps, (fw,fh))
-                    if not out.isOpened():
-                        msg = f"Error opening VideoWriter: {current_clip_path}"
-                        st.error(msg); write_log(msg, status_ph, is_error=True, db_video_source=db_source_name)
-                        st.session_state.stop_camera=True; break
-                    recording = True
-                    write_log(f"REC Start: {vid_fname}", status_ph, log_level_for_db="RECORDING_EVENT", db_clip_path=current_clip_path)
-                if recording and out: out.write(frame) # Original frame
-                log_ts = now_time.strftime("%I:%M:%S %p")
-                write_log(f"{detected_weapon_name} detected @{log_ts}", status_ph, log_level_for_db="DETECTION", db_clip_path=current_clip_path if recording else None)
-            else: # No weapon
-                if recording:
-                    recording=False
-                    if out: out.release(); out=None
-                    write_log(f"REC Stop: {os.path.basename(current_clip_path)}", status_ph, log_level_for_db="RECORDING_EVENT", db_clip_path=current_clip_path)
-                    current_clip_path = ""
-            
-            rgb_frame = cv2.cvtColor(annot_frame, cv2.COLOR_BGR2RGB)
-            frame_placeholder.image(rgb_frame, channels="RGB", use_container_width=True)
     finally:
+        stop_event.set()
+        reader.join() # Reader must be out of cap.read() before the capture is released
         if cap: cap.release()
         if recording and out: # If loop/app stops while recording
-            out.release()
+            q_out.put((out, None))
             write_log(f"REC Finalized (incomplete?): {os.path.basename(current_clip_path)}", status_ph, log_level_for_db="RECORDING_EVENT", db_clip_path=current_clip_path)
+        q_out.put(None); clip_writer.join() # Flush queued clip frames before reporting the loop ended
+        # Also runs when the Stop button's rerun interrupts the loop. The last batch's device tensor and results are
+        # still referenced here until the function returns, so drop them before handing cached VRAM back to the driver
+        del tensor, weapon_res, effect_res, annot_frame
+        gc.collect()
+        if torch.cuda.is_available(): torch.cuda.empty_cache()
         write_log("Processing loop ended.", status_ph, db_video_source=db_source_name)
+        wait_for_db_logs() # Last REC/loop-ended rows reach MySQL before the run finishes
         st.session_state.is_processing = False
         st.session_state.stop_camera = True # Ensure stop is true
 
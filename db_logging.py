@@ -0,0 +1,139 @@
+# --- Asynchronous MySQL logging ---
+# Kept out of app4.py on purpose: Streamlit runs the script in a fresh __main__ module on every rerun, and a
+# long-lived worker thread or atexit hook defined there would keep that run's globals (models included) alive.
+# This module is imported once per server process, so its state and worker outlive reruns without pinning them.
+import atexit
+import queue
+import threading
+import time
+from datetime import datetime
+from mysql.connector import Error # For MySQL error handling
+from mysql.connector import pooling # Shared connection pool
+
+DB_RETRY_INTERVAL = 30 # Seconds before a failed pool creation is attempted again
+DB_CONNECT_TIMEOUT = 5 # Seconds per connection attempt; mysql-connector waits indefinitely by default
+DB_LOG_BATCH_SIZE = 64 # Max rows per executemany()
+DB_LOG_FLUSH_TIMEOUT = 2.0 # Max seconds to wait for queued rows at the end of a run / at server exit
+
+_pool_state = {"pool": None, "retry_at": 0.0, "error": None, "attempted": False} # Shared with the worker; the script thread only reads it
+_log_q = None
+_start_lock = threading.Lock() # Concurrent sessions may rerun at the same time
+
+def start_db_logging(db_config):
+    # Starts the queue + worker once per server process; later calls are no-ops
+    global _log_q
+    with _start_lock:
+        if _log_q is None:
+            log_q = queue.Queue()
+            threading.Thread(target=db_log_worker, args=(log_q, _pool_state, dict(db_config)), daemon=True).start()
+            atexit.register(wait_for_db_logs, log_q) # Daemon worker is still alive during atexit, so queued rows get written
+            _log_q = log_q
+    return _log_q
+
+def db_connecting():
+    # True until the worker's first pool creation attempt has finished (up to DB_CONNECT_TIMEOUT). Never blocks.
+    return not _pool_state["attempted"]
+
+def db_connection_error():
+    # Last pool creation error, or None while connected / before the worker's first attempt. Never blocks.
+    return _pool_state["error"]
+
+def get_db_pool(state, db_config):
+    # Shared pool, or None while MySQL is unreachable. Only the log worker calls this, so dialing never blocks the UI.
+    if state["pool"] is None and time.monotonic() >= state["retry_at"]:
+        try:
+            pool = pooling.MySQLConnectionPool(pool_name="wd", pool_size=4, connection_timeout=DB_CONNECT_TIMEOUT, **db_config)
+            print("Successfully created MySQL connection pool")
+            conn = pool.get_connection()
+            try: create_logs_table_if_not_exists(conn)
+            finally: conn.close() # Returns the connection to the pool
+            state["pool"] = pool; state["error"] = None
+        except Error as e:
+            state["retry_at"] = time.monotonic() + DB_RETRY_INTERVAL # Don't re-dial for every batch while MySQL is down
+            state["error"] = str(e)
+            print(f"DB Connection Error: {e} (next attempt in {DB_RETRY_INTERVAL}s)")
+        finally:
+            state["attempted"] = True
+    return state["pool"]
+
+def create_logs_table_if_not_exists(_conn):
+    cursor = None
+    try:
+        cursor = _conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS detection_logs (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                timestamp DATETIME NOT NULL,
+                log_level VARCHAR(20) NOT NULL,
+                message TEXT NOT NULL,
+                video_source VARCHAR(255) NULL,
+                clip_path VARCHAR(255) NULL
+            );
+        """)
+        _conn.commit()
+        print("detection_logs table checked/created successfully.")
+    except Error as e:
+        print(f"DB Table Creation Error: {e}")
+    finally:
+        if cursor:
+            cursor.close()
+
+def wait_for_db_logs(log_q=None, timeout=DB_LOG_FLUSH_TIMEOUT):
+    # Bounded Queue.join(): returns once the worker has handled every queued row, or after timeout
+    log_q = log_q or _log_q
+    if log_q is None: return
+    deadline = time.monotonic() + timeout
+    with log_q.all_tasks_done:
+        while log_q.unfinished_tasks and time.monotonic() < deadline:
+            log_q.all_tasks_done.wait(deadline - time.monotonic())
+
+def db_log_worker(log_q, pool_state, db_config):
+    get_db_pool(pool_state, db_config) # Connect and create the table at startup rather than on the first log row
+    conn = None # Checked out once and held for the process lifetime; replaced only if it drops
+    while True:
+        batch = [log_q.get()] # Block until there is something to write, then drain what else is queued
+        while len(batch) < DB_LOG_BATCH_SIZE:
+            try: batch.append(log_q.get_nowait())
+            except queue.Empty: break
+        try:
+            if conn is None or not conn.is_connected(): conn = checkout_log_connection(pool_state, db_config, conn)
+            if conn is None: print(f"DB LOG SKIP (No Connection): {len(batch)} queued log rows dropped")
+            else: insert_log_rows(conn, batch)
+        finally:
+            for _ in batch: log_q.task_done()
+
+def checkout_log_connection(pool_state, db_config, stale_conn=None):
+    if stale_conn is not None:
+        try: stale_conn.close() # Hands a pooled connection back to the pool
+        except Error: pass
+    pool = get_db_pool(pool_state, db_config)
+    if pool is None: return None
+    try:
+        return pool.get_connection()
+    except Error as e:
+        print(f"DB LOG worker connection error: {e}")
+        return None
+
+def insert_log_rows(conn, batch):
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        sql = """
+            INSERT INTO detection_logs (timestamp, log_level, message, video_source, clip_path)
+            VALUES (%s, %s, %s, %s, %s)
+        """
+        cursor.executemany(sql, batch) # Connector rewrites this into a single multi-row INSERT
+        conn.commit()
+    except Error as e:
+        print(f"DB LOG WRITE ERROR: {e} for {len(batch)} queued log rows") # Log to console, not st.error
+        try: conn.rollback()
+        except Error: pass # Connection is gone; the worker checks out a fresh one next batch
+    finally:
+        if cursor: cursor.close()
+
+def write_log_to_db(level, message, video_source=None, clip_path=None):
+    # Never blocks the frame loop: the worker thread does all MySQL I/O. Rows are dropped before start_db_logging().
+    if _log_q is None: return
+    _log_q.put_nowait((datetime.now(), str(level).upper(), str(message),
+                       str(video_source) if video_source else None,
+                       str(clip_path) if clip_path else None))